@@ -5,14 +5,16 @@ May require admin privileges on Windows, due to issue where
 PyInstaller doesn't embed a sensible default manifest in the EXE.
 """
 from argparse import Namespace
+import ctypes
+import errno
 import gzip
+import hashlib
 import json
 import logging
 import os
 import shutil
 import subprocess
 import sys
-import tarfile
 import tempfile
 import unittest
 import zipfile
@@ -20,13 +22,10 @@ import zipfile
 import appdirs
 import bsdiff4
 import ed25519
-import psutil
-import six
 
 import wxupdatedemo
 
 from dsdev_utils.system import get_system
-from dsdev_utils.crypto import get_package_hashes
 from pyupdater import settings
 from pyupdater.builder import Builder
 
@@ -132,128 +131,261 @@ KEYS = {
                 "+oosN3KiO8DlxOmyfuwaaQKtFCw")
 }
 
+# Environment variables passed through to the frozen app.  Besides the
+# WXUPDATEDEMO_TESTING* variables, it needs a temp dir to unpack itself
+# into (PyUpdater builds with --onefile), and the same home / app data
+# locations as this test, so that appdirs finds the same user data dir:
+CHILD_ENV_VARS = (
+    'WXUPDATEDEMO_TESTING', 'WXUPDATEDEMO_TESTING_FROZEN',
+    'WXUPDATEDEMO_TESTING_APP_NAME', 'WXUPDATEDEMO_TESTING_COMPANY_NAME',
+    'WXUPDATEDEMO_TESTING_APP_VERSION', 'WXUPDATEDEMO_TESTING_PUBLIC_KEY',
+    'PATH', 'SystemRoot', 'TEMP', 'TMP', 'TMPDIR',
+    'HOME', 'XDG_DATA_HOME', 'USERPROFILE', 'APPDATA', 'LOCALAPPDATA',
+    'DISPLAY', 'XAUTHORITY', 'LANG')
+
+# Windows constants used by PidIsRunning:
+PROCESS_QUERY_INFORMATION = 0x0400
+STILL_ACTIVE = 259
+
+
+def GetPackageHash(data):
+    """
+    Return the hash PyUpdater expects for a package or patch.
+
+    PyUpdater's client verifies downloads with SHA256 (see
+    dsdev_utils.crypto.get_package_hashes), so we can't use a faster
+    hash here.  Hashing the whole payload in one call lets hashlib
+    hand it straight to OpenSSL.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def WriteGzipFile(path, data):
+    """
+    Write data to a gzipped test fixture, e.g. versions.gz.
+
+    These throwaway fixtures don't need gzip's default (slowest)
+    compression level.
+    """
+    with gzip.open(path, 'wb', compresslevel=1) as gzipFile:
+        gzipFile.write(data)
+
 
 def PidIsRunning(pid):
     """
     Check if a process with PID pid is running.
+
+    On Windows, we open a handle to the process and check that it
+    hasn't exited.  On other platforms, we send signal 0, which only
+    checks whether the process exists.  Note that a zombie process
+    still counts as running on those platforms.
     """
-    try:
-        proc = psutil.Process(int(pid))
-        if proc.status == psutil.STATUS_DEAD:
-            return False
-        if proc.status == psutil.STATUS_ZOMBIE:
+    if sys.platform.startswith('win'):
+        # ctypes.wintypes can only be imported on Windows (on Python 2):
+        from ctypes import wintypes
+        # Use our own WinDLL instance, so that setting restype and
+        # argtypes doesn't affect other users of ctypes.windll.kernel32.
+        # Without them, the HANDLE returned by OpenProcess would be
+        # truncated to a C int on 64-bit Windows:
+        kernel32 = ctypes.WinDLL('kernel32')
+        kernel32.OpenProcess.restype = wintypes.HANDLE
+        kernel32.OpenProcess.argtypes = \
+            [wintypes.DWORD, wintypes.BOOL, wintypes.DWORD]
+        kernel32.GetExitCodeProcess.restype = wintypes.BOOL
+        kernel32.GetExitCodeProcess.argtypes = \
+            [wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD)]
+        kernel32.CloseHandle.restype = wintypes.BOOL
+        kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+        handle = kernel32.OpenProcess(PROCESS_QUERY_INFORMATION, False,
+                                      int(pid))
+        if not handle:
             return False
-        return True  # Assume other status are valid
-    except psutil.NoSuchProcess:
-        return False
+        try:
+            exitCode = wintypes.DWORD()
+            if not kernel32.GetExitCodeProcess(handle,
+                                               ctypes.byref(exitCode)):
+                return False
+            return exitCode.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(int(pid), 0)
+    except OSError as err:
+        # EPERM means the process exists, but belongs to another user:
+        return err.errno == errno.EPERM
+    return True
 
 
 class FreezeUpdateAvailableTester(unittest.TestCase):
     """
     Test ability to freeze and run app with an update available.
+
+    Freezing the app with PyInstaller is by far the slowest part of
+    this test, so it is done once in setUpClass.  Each test method
+    then runs the frozen app against its own copy of the pristine
+    file server directory, after restoring the user data directory
+    from a pristine snapshot.
+
+    unittest runs test methods in alphabetical order, so the test
+    names are prefixed to check the build first and then run the
+    cheapest scenario (a failed download) before the others.
     """
+    initialWorkingDir = None
+    # fileServerDir is never modified; each test gets its own copy:
+    fileServerDir = None
+    # tempDir contains .pyupdater/config.pyu, pyu-data/new/ :
+    tempDir = None
+    # userDataDir is where the frozen app's PyUpdater client keeps its data:
+    userDataDir = None
+    # snapshotDir contains userDataSnapshotDir, a pristine copy of userDataDir:
+    snapshotDir = None
+    userDataSnapshotDir = None
+    updateFilename = None
+    buildFilename = None
+    newDir = None
+    pathToExe = None
+    builtExe = False
+    # childEnv is the minimal environment for running the frozen app:
+    childEnv = None
+    # signingKey is created once and reused whenever VERSIONS is signed:
+    signingKey = None
+    # Archive contents, kept for generating the patch in PreparePatch:
+    currentPayload = None
+    updatePayload = None
+    originalVersion = None
+
     def __init__(self, *args, **kwargs):
         super(FreezeUpdateAvailableTester, self).__init__(*args, **kwargs)
-        self.initialWorkingDir = None
-        self.fileServerDir = None
-        # self.tempDir contains .pyupdater/config.pyu, pyu-data/new/ :
-        self.tempDir = None
-        self.updateFilename = None
-        self.originalVersion = wxupdatedemo.__version__
+        self.scenarioFileServerDir = None
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
+        """
+        Create the test fixtures and freeze the app.
+
+        unittest doesn't call tearDownClass if setUpClass fails, so we
+        call it ourselves.  Otherwise a failed build would leave the
+        WXUPDATEDEMO_TESTING* environment variables set, which breaks
+        the tests in other modules.
+        """
+        cls.initialWorkingDir = os.getcwd()
+        cls.originalVersion = wxupdatedemo.__version__
+        try:
+            cls.CreateFixtures()
+            cls.FreezeApp()
+        except:  # pylint: disable=bare-except
+            cls.tearDownClass()
+            raise
+
+    @classmethod
+    def CreateFixtures(cls):
+        """
+        Create the file server and user data fixtures.
+        """
         # pylint: disable=too-many-statements
         # pylint: disable=too-many-locals
-        self.initialWorkingDir = os.getcwd()
-
-        userDataDir = appdirs.user_data_dir(APP_NAME, COMPANY_NAME)
-        if os.path.exists(userDataDir):
-            shutil.rmtree(userDataDir)
-        os.makedirs(userDataDir)
-        versionsUserDataFilePath = os.path.join(userDataDir, 'versions.gz')
-        userDataUpdateDir = os.path.join(userDataDir, "update")
+        cls.userDataDir = appdirs.user_data_dir(APP_NAME, COMPANY_NAME)
+        if os.path.exists(cls.userDataDir):
+            shutil.rmtree(cls.userDataDir)
+        os.makedirs(cls.userDataDir)
+        versionsUserDataFilePath = \
+            os.path.join(cls.userDataDir, 'versions.gz')
+        userDataUpdateDir = os.path.join(cls.userDataDir, "update")
         os.mkdir(userDataUpdateDir)
         system = get_system()
-        self.currentFilename = \
+        currentFilename = \
             VERSIONS['updates'][APP_NAME][CURRENT_VERSION_PYU_FORMAT]\
             [system]['filename']
-        currentFilePath = os.path.join(userDataUpdateDir, self.currentFilename)
+        currentFilePath = os.path.join(userDataUpdateDir, currentFilename)
+        # Pad the archive contents with NUL bytes up to FILE_SIZE, and
+        # hash the in-memory payload rather than reading the file back:
+        cls.currentPayload = \
+            CURRENT_VERSION.encode('utf-8').ljust(FILE_SIZE, b'\0')
         with open(currentFilePath, "wb") as currentFile:
-            currentFile.write("%s" % CURRENT_VERSION)
-            currentFile.seek(FILE_SIZE - 1)
-            currentFile.write("\0")
-        fileHash = get_package_hashes(currentFilePath)
+            currentFile.write(cls.currentPayload)
+        fileHash = GetPackageHash(cls.currentPayload)
         VERSIONS['updates'][APP_NAME][CURRENT_VERSION_PYU_FORMAT]\
             [system]['file_hash'] = fileHash
 
         tempFile = tempfile.NamedTemporaryFile()
-        self.fileServerDir = tempFile.name
+        cls.fileServerDir = tempFile.name
         tempFile.close()
-        os.mkdir(self.fileServerDir)
-        os.chdir(self.fileServerDir)
+        os.mkdir(cls.fileServerDir)
 
-        self.updateFilename = \
+        cls.updateFilename = \
             VERSIONS['updates'][APP_NAME][UPDATE_VERSION_PYU_FORMAT]\
             [system]['filename']
-        with open(self.updateFilename, "wb") as updateFile:
-            updateFile.write("%s" % UPDATE_VERSION)
-            updateFile.seek(FILE_SIZE - 1)
-            updateFile.write("\0")
-        os.chdir(self.fileServerDir)
-        fileHash = get_package_hashes(self.updateFilename)
+        cls.updatePayload = \
+            UPDATE_VERSION.encode('utf-8').ljust(FILE_SIZE, b'\0')
+        updateFilePath = os.path.join(cls.fileServerDir, cls.updateFilename)
+        with open(updateFilePath, "wb") as updateFile:
+            updateFile.write(cls.updatePayload)
+        fileHash = GetPackageHash(cls.updatePayload)
         VERSIONS['updates'][APP_NAME][UPDATE_VERSION_PYU_FORMAT]\
             [system]['file_hash'] = fileHash
-        self.patchFilename = \
-            VERSIONS['updates'][APP_NAME][UPDATE_VERSION_PYU_FORMAT]\
-            [system]['patch_name']
-        bsdiff4.file_diff(currentFilePath, self.updateFilename,
-                          self.patchFilename)
-        os.chdir(self.fileServerDir)
-        fileHash = get_package_hashes(self.patchFilename)
-        VERSIONS['updates'][APP_NAME][UPDATE_VERSION_PYU_FORMAT]\
-            [system]['patch_hash'] = fileHash
-        os.chdir(self.initialWorkingDir)
-        privateKey = ed25519.SigningKey(PRIVATE_KEY.encode('utf-8'),
-                                        encoding='base64')
-        signature = privateKey.sign(six.b(json.dumps(VERSIONS, sort_keys=True)),
-                                    encoding='base64').decode()
-        VERSIONS['signature'] = signature
-        keysFilePath = os.path.join(self.fileServerDir, 'keys.gz')
-        with gzip.open(keysFilePath, 'wb') as keysFile:
-            keysFile.write(json.dumps(KEYS, sort_keys=True))
-        versionsFilePath = os.path.join(self.fileServerDir, 'versions.gz')
-        with gzip.open(versionsFilePath, 'wb') as versionsFile:
-            versionsFile.write(json.dumps(VERSIONS, sort_keys=True))
-        with gzip.open(versionsUserDataFilePath, 'wb') as versionsFile:
-            versionsFile.write(json.dumps(VERSIONS, sort_keys=True))
+        # The patch (and its patch_hash) is only generated by
+        # test_c_patch_update, see PreparePatch.  The other scenarios
+        # remove the base archive from the user data directory, so
+        # PyUpdater never looks for a patch.
+        cls.signingKey = ed25519.SigningKey(PRIVATE_KEY.encode('utf-8'),
+                                            encoding='base64')
+        # Serialize the signed versions once, for both versions.gz files:
+        versionsJson = cls.SignVersions()
+        WriteGzipFile(os.path.join(cls.fileServerDir, 'keys.gz'),
+                      json.dumps(KEYS, sort_keys=True).encode('utf-8'))
+        WriteGzipFile(os.path.join(cls.fileServerDir, 'versions.gz'),
+                      versionsJson)
+        WriteGzipFile(versionsUserDataFilePath, versionsJson)
 
         tempFile = tempfile.NamedTemporaryFile()
-        self.tempDir = tempFile.name
+        cls.snapshotDir = tempFile.name
         tempFile.close()
-        settings.CONFIG_DATA_FOLDER = os.path.join(self.tempDir, '.pyupdater')
-        settings.USER_DATA_FOLDER = os.path.join(self.tempDir, 'pyu-data')
-        os.mkdir(self.tempDir)
+        os.mkdir(cls.snapshotDir)
+        cls.userDataSnapshotDir = os.path.join(cls.snapshotDir, 'userdata')
+        shutil.copytree(cls.userDataDir, cls.userDataSnapshotDir)
+
+        tempFile = tempfile.NamedTemporaryFile()
+        cls.tempDir = tempFile.name
+        tempFile.close()
+        settings.CONFIG_DATA_FOLDER = os.path.join(cls.tempDir, '.pyupdater')
+        settings.USER_DATA_FOLDER = os.path.join(cls.tempDir, 'pyu-data')
+        os.mkdir(cls.tempDir)
         os.mkdir(settings.USER_DATA_FOLDER)
         os.mkdir(settings.CONFIG_DATA_FOLDER)
         # The way we set the App name below avoids having to
         # create .pyupdater/config.pyu:
         settings.GENERIC_APP_NAME = APP_NAME
         settings.GENERIC_COMPANY_NAME = COMPANY_NAME
-        os.environ['PYUPDATER_FILESERVER_DIR'] = self.fileServerDir
         os.environ['WXUPDATEDEMO_TESTING'] = 'True'
         os.environ['WXUPDATEDEMO_TESTING_FROZEN'] = 'True'
         os.environ['WXUPDATEDEMO_TESTING_APP_NAME'] = APP_NAME
         os.environ['WXUPDATEDEMO_TESTING_COMPANY_NAME'] = COMPANY_NAME
         os.environ['WXUPDATEDEMO_TESTING_APP_VERSION'] = CURRENT_VERSION
         os.environ['WXUPDATEDEMO_TESTING_PUBLIC_KEY'] = PUBLIC_KEY
+        cls.childEnv = dict((key, os.environ[key]) for key in CHILD_ENV_VARS
+                            if key in os.environ)
 
-    def test_freeze_update_available(self):
+    @classmethod
+    def SignVersions(cls):
         """
-        Test ability to freeze and run app with an update available.
+        Sign VERSIONS with signingKey and return the signed manifest
+        as JSON bytes, ready to be written to versions.gz.
+
+        Any previous signature is discarded first, so VERSIONS can
+        be signed again after its hashes have changed.
         """
-        # pylint: disable=too-many-branches
-        # pylint: disable=too-many-locals
-        # pylint: disable=too-many-statements
+        VERSIONS.pop('signature', None)
+        versionsJson = json.dumps(VERSIONS, sort_keys=True).encode('utf-8')
+        VERSIONS['signature'] = \
+            cls.signingKey.sign(versionsJson, encoding='base64').decode()
+        return json.dumps(VERSIONS, sort_keys=True).encode('utf-8')
+
+    @classmethod
+    def FreezeApp(cls):
+        """
+        Freeze the app with PyUpdater / PyInstaller and extract the build.
+        """
+        system = get_system()
 
         # PyUpdater uses PyInstaller under the hood.  We will customize
         # the command-line arguments PyUpdater sends to PyInstaller.
@@ -264,7 +396,7 @@ class FreezeUpdateAvailableTester(unittest.TestCase):
 
         pyiArgs = ['--hidden-import=SocketServer', 'run.py']
 
-        if get_system() == 'mac':
+        if system == 'mac':
             # On Mac, we need to use PyInstaller's --windowed option to create
             # an app bundle, otherwise attempting to run the frozen application
             # gives this error:
@@ -280,141 +412,210 @@ class FreezeUpdateAvailableTester(unittest.TestCase):
         else:
             pyiArgs = ['--console'] + pyiArgs
         wxupdatedemo.__version__ = CURRENT_VERSION
+        # PyUpdater's Builder ignores workpath: it always passes
+        # <CONFIG_DATA_FOLDER>/work to PyInstaller and removes it before
+        # building, so PyInstaller's analysis can't be reused between runs.
+        # Leaving clean=False at least preserves PyInstaller's own cache.
         args = Namespace(app_version=CURRENT_VERSION, clean=False,
                          command='build', distpath=None, keep=False,
                          name=None, onedir=False, onefile=False,
                          specpath=None, workpath=None)
         builder = Builder(args, pyiArgs)
         builder.build()
-        if get_system() == 'win':
+        if system == 'win':
             ext = '.zip'
         else:
             ext = '.tar.gz'
-        buildFilename = \
-            '%s-%s-%s%s' % (APP_NAME, get_system(), CURRENT_VERSION, ext)
-        newDir = os.path.join(settings.USER_DATA_FOLDER, 'new')
-        self.assertEqual(os.listdir(newDir), [buildFilename])
-        os.chdir(newDir)
+        cls.buildFilename = \
+            '%s-%s-%s%s' % (APP_NAME, system, CURRENT_VERSION, ext)
+        cls.newDir = os.path.join(settings.USER_DATA_FOLDER, 'new')
+        # The build is extracted once here, and every test runs the
+        # extracted executable:
+        buildFilePath = os.path.join(cls.newDir, cls.buildFilename)
+        if system == 'win':
+            with zipfile.ZipFile(buildFilePath, 'r') as zipFile:
+                zipFile.extractall(cls.newDir)
+            cls.pathToExe = os.path.join(cls.newDir, '%s.exe' % APP_NAME)
+        else:
+            # The system tar is much faster than the pure Python tarfile
+            # module for extracting a large .tar.gz:
+            subprocess.check_call(
+                ['tar', '-xzf', buildFilePath, '-C', cls.newDir])
+            if system == 'mac':
+                cls.pathToExe = os.path.join(cls.newDir, '%s.app' % APP_NAME,
+                                             'Contents', 'MacOS', APP_NAME)
+            else:  # Linux / Unix
+                cls.pathToExe = os.path.join(cls.newDir, APP_NAME)
+        cls.builtExe = os.path.exists(cls.pathToExe)
+
+    def setUp(self):
+        """
+        Give this test its own copy of the file server directory and
+        restore the user data directory from the pristine snapshot.
+
+        The user data directory can't be sandboxed in the same way,
+        because the frozen app always uses appdirs.user_data_dir.
+        """
+        tempFile = tempfile.NamedTemporaryFile()
+        self.scenarioFileServerDir = tempFile.name
+        tempFile.close()
+        shutil.copytree(self.fileServerDir, self.scenarioFileServerDir)
+        if os.path.exists(self.userDataDir):
+            shutil.rmtree(self.userDataDir)
+        shutil.copytree(self.userDataSnapshotDir, self.userDataDir)
+
+    def test_a_build(self):
+        """
+        Test that freezing the app produced the expected build.
+        """
         if get_system() == 'win':
-            with zipfile.ZipFile(buildFilename, 'r') as zipFile:
-                zipFile.extractall()
-            pathToExe = '%s.exe' % APP_NAME
-            self.assertEqual(sorted(os.listdir('.')),
-                             [buildFilename, pathToExe])
+            self.assertEqual(set(os.listdir(self.newDir)),
+                             {self.buildFilename, '%s.exe' % APP_NAME})
         elif get_system() == 'mac':
-            tar = tarfile.open(buildFilename, "r:gz")
-            tar.extractall()
-            tar.close()
             appBundleName = '%s.app' % APP_NAME
-            self.assertEqual(sorted(os.listdir('.')),
-                             [buildFilename, appBundleName])
-            pathToExe = os.path.join(newDir, '%s.app' % APP_NAME,
-                                     'Contents', 'MacOS', APP_NAME)
+            self.assertEqual(set(os.listdir(self.newDir)),
+                             {self.buildFilename, appBundleName})
         else:  # Linux / Unix
-            tar = tarfile.open(buildFilename, "r:gz")
-            tar.extractall()
-            tar.close()
-            pathToExe = os.path.join(newDir, APP_NAME)
+            self.assertEqual(set(os.listdir(self.newDir)),
+                             {self.buildFilename, APP_NAME})
 
-        sys.stderr.write("\n\nTesting ability to apply patch update...\n")
+    def RunExeAndCheckOutput(self, successMessage, expectedStatus):
+        """
+        Run the frozen app and check its output.
 
-        cmdList = [pathToExe, '--debug']
-        runExeProc = subprocess.Popen(cmdList,
-                                      stdout=subprocess.PIPE,
-                                      stderr=subprocess.STDOUT,
-                                      env=os.environ.copy())
-        runExeStdout, _ = runExeProc.communicate()
-        logger.debug(runExeStdout)
-        self.assertEqual(runExeProc.returncode, 0)
-        appliedPatchSuccessfully = False
-        statusPrefix = "Exiting with status: "
-        for line in runExeStdout.splitlines():
-            if "Applied patch successfully" in line:
-                sys.stderr.write("\t%s\n" % line)
-                appliedPatchSuccessfully = True
-            if line.startswith("Exiting with status: "):
-                sys.stderr.write("\t%s\n" % line)
-                status = line.split(statusPrefix)[1]
-                self.assertEqual(status, "Extracting update and restarting.")
-        self.assertTrue(appliedPatchSuccessfully)
+        The app's output must contain successMessage and it must
+        report expectedStatus in its "Exiting with status: " line.
 
-        # Remove all local data from previous PyUpdater downloads:
-        if os.path.exists(appdirs.user_data_dir(APP_NAME, COMPANY_NAME)):
-            shutil.rmtree(appdirs.user_data_dir(APP_NAME, COMPANY_NAME))
-        # Now we can't patch because there's no base binary to patch from:
-        sys.stderr.write("\nTesting ability to download full update...\n")
+        If the build didn't produce an executable, test_a_build reports
+        the failure and the scenarios are skipped rather than each
+        failing to launch it.
+        """
+        if not self.builtExe:
+            self.skipTest("Frozen app executable wasn't built.")
+        cmdList = [self.pathToExe, '--debug']
+        env = dict(self.childEnv)
+        env['PYUPDATER_FILESERVER_DIR'] = self.scenarioFileServerDir
         runExeProc = subprocess.Popen(cmdList,
                                       stdout=subprocess.PIPE,
                                       stderr=subprocess.STDOUT,
-                                      env=os.environ.copy())
-        runExeStdout, _ = runExeProc.communicate()
-        logger.debug(runExeStdout)
-        self.assertEqual(runExeProc.returncode, 0)
-        fullDownloadSuccessful = False
+                                      env=env)
+        foundSuccessMessage = False
         statusPrefix = "Exiting with status: "
-        for line in runExeStdout.splitlines():
-            if "Full download successful" in line:
+        statusPrefixLength = len(statusPrefix)
+        status = None
+        debugLines = []
+        # Scan the output as it is produced, rather than buffering it all:
+        for rawLine in iter(runExeProc.stdout.readline, b''):
+            line = rawLine.decode('utf-8', 'replace').rstrip('\r\n')
+            if logger.isEnabledFor(logging.DEBUG):
+                debugLines.append(line)
+            if successMessage in line:
                 sys.stderr.write("\t%s\n" % line)
-                fullDownloadSuccessful = True
-            if line.startswith("Exiting with status: "):
+                foundSuccessMessage = True
+            if line.startswith(statusPrefix):
                 sys.stderr.write("\t%s\n" % line)
-                status = line.split(statusPrefix)[1]
-                self.assertEqual(status, "Extracting update and restarting.")
-        self.assertTrue(fullDownloadSuccessful)
+                status = line[statusPrefixLength:]
+        runExeProc.stdout.close()
+        runExeProc.wait()
+        logger.debug("\n".join(debugLines))
+        self.assertEqual(runExeProc.returncode, 0)
+        self.assertEqual(status, expectedStatus)
+        self.assertTrue(foundSuccessMessage)
 
+    def test_b_failed_download(self):
+        """
+        Test ability to freeze and run app and report a failed download.
+        """
         # Remove all local data from previous PyUpdater downloads:
-        if os.path.exists(appdirs.user_data_dir(APP_NAME, COMPANY_NAME)):
-            shutil.rmtree(appdirs.user_data_dir(APP_NAME, COMPANY_NAME))
+        if os.path.exists(self.userDataDir):
+            shutil.rmtree(self.userDataDir)
         # Remove update archive from file server:
-        os.remove(os.path.join(self.fileServerDir,
+        os.remove(os.path.join(self.scenarioFileServerDir,
                                self.updateFilename))
         # Now attempting to update should fail - can't download update.
         sys.stderr.write(
             "\nTesting ability to report failed download of update...\n")
-        runExeProc = subprocess.Popen(cmdList,
-                                      stdout=subprocess.PIPE,
-                                      stderr=subprocess.STDOUT,
-                                      env=os.environ.copy())
-        runExeStdout, _ = runExeProc.communicate()
-        logger.debug(runExeStdout)
-        self.assertEqual(runExeProc.returncode, 0)
-        statusPrefix = "Exiting with status: "
-        fullDownloadFailed = False
-        for line in runExeStdout.splitlines():
-            if "Full download failed" in line:
-                sys.stderr.write("\t%s\n" % line)
-                fullDownloadFailed = True
-            if line.startswith("Exiting with status: "):
-                sys.stderr.write("\t%s\n" % line)
-                status = line.split(statusPrefix)[1]
-                self.assertEqual(status, "Update download failed.")
-        self.assertTrue(fullDownloadFailed)
+        self.RunExeAndCheckOutput("Full download failed",
+                                  "Update download failed.")
 
+    def PreparePatch(self):
+        """
+        Generate the patch from the current version to the update, and
+        sign and install a versions.gz manifest which includes it.
+        """
+        system = get_system()
+        updateInfo = VERSIONS['updates'][APP_NAME][UPDATE_VERSION_PYU_FORMAT]\
+            [system]
+        patchPayload = bsdiff4.diff(self.currentPayload, self.updatePayload)
+        patchFilePath = os.path.join(self.scenarioFileServerDir,
+                                     updateInfo['patch_name'])
+        with open(patchFilePath, "wb") as patchFile:
+            patchFile.write(patchPayload)
+        updateInfo['patch_hash'] = GetPackageHash(patchPayload)
+        try:
+            versionsJson = self.SignVersions()
+        finally:
+            updateInfo['patch_hash'] = None
+        WriteGzipFile(os.path.join(self.scenarioFileServerDir, 'versions.gz'),
+                      versionsJson)
+        WriteGzipFile(os.path.join(self.userDataDir, 'versions.gz'),
+                      versionsJson)
+
+    def test_c_patch_update(self):
+        """
+        Test ability to freeze and run app and apply a patch update.
+        """
+        self.PreparePatch()
+        sys.stderr.write("\n\nTesting ability to apply patch update...\n")
+        self.RunExeAndCheckOutput("Applied patch successfully",
+                                  "Extracting update and restarting.")
+
+    def test_d_full_download(self):
+        """
+        Test ability to freeze and run app and download a full update.
+        """
+        # Remove all local data from previous PyUpdater downloads:
+        if os.path.exists(self.userDataDir):
+            shutil.rmtree(self.userDataDir)
+        # Now we can't patch because there's no base binary to patch from:
+        sys.stderr.write("\nTesting ability to download full update...\n")
+        self.RunExeAndCheckOutput("Full download successful",
+                                  "Extracting update and restarting.")
 
     def tearDown(self):
         """
-        Clean up.
+        Remove this test's copy of the file server directory.
         """
-        wxupdatedemo.__version__ = self.originalVersion
         try:
-            shutil.rmtree(self.tempDir)
+            shutil.rmtree(self.scenarioFileServerDir)
         except OSError:
-            logger.warning("Couldn't remove %s", self.tempDir)
-        os.chdir(self.initialWorkingDir)
-        try:
-            shutil.rmtree(self.fileServerDir)
-        except OSError:
-            logger.warning("Couldn't remove %s", self.fileServerDir)
-        del os.environ['PYUPDATER_FILESERVER_DIR']
-        del os.environ['WXUPDATEDEMO_TESTING']
-        del os.environ['WXUPDATEDEMO_TESTING_FROZEN']
-        del os.environ['WXUPDATEDEMO_TESTING_APP_NAME']
-        del os.environ['WXUPDATEDEMO_TESTING_COMPANY_NAME']
-        del os.environ['WXUPDATEDEMO_TESTING_APP_VERSION']
-        del os.environ['WXUPDATEDEMO_TESTING_PUBLIC_KEY']
-        if os.path.exists(appdirs.user_data_dir(APP_NAME, COMPANY_NAME)):
+            logger.warning("Couldn't remove %s", self.scenarioFileServerDir)
+
+    @classmethod
+    def tearDownClass(cls):
+        """
+        Clean up.
+
+        Also called by setUpClass if it fails, so anything it hasn't
+        created yet is skipped.
+        """
+        wxupdatedemo.__version__ = cls.originalVersion
+        os.chdir(cls.initialWorkingDir)
+        for path in (cls.tempDir, cls.fileServerDir, cls.snapshotDir):
+            if path is None or not os.path.exists(path):
+                continue
+            try:
+                shutil.rmtree(path)
+            except OSError:
+                logger.warning("Couldn't remove %s", path)
+        os.environ.pop('WXUPDATEDEMO_TESTING', None)
+        os.environ.pop('WXUPDATEDEMO_TESTING_FROZEN', None)
+        os.environ.pop('WXUPDATEDEMO_TESTING_APP_NAME', None)
+        os.environ.pop('WXUPDATEDEMO_TESTING_COMPANY_NAME', None)
+        os.environ.pop('WXUPDATEDEMO_TESTING_APP_VERSION', None)
+        os.environ.pop('WXUPDATEDEMO_TESTING_PUBLIC_KEY', None)
+        if cls.userDataDir and os.path.exists(cls.userDataDir):
             try:
-                shutil.rmtree(appdirs.user_data_dir(APP_NAME, COMPANY_NAME))
+                shutil.rmtree(cls.userDataDir)
             except OSError:
-                logger.warning("Couldn't remove %s",
-                               appdirs.user_data_dir(APP_NAME, COMPANY_NAME))
+                logger.warning("Couldn't remove %s", cls.userDataDir)
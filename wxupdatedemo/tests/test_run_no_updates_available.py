@@ -17,7 +17,6 @@ import shutil
 import tempfile
 
 import ed25519
-import six
 import wx
 
 from wxupdatedemo import __version__
@@ -86,8 +85,8 @@ class RunTester(unittest.TestCase):
         os.environ['PYUPDATER_FILESERVER_DIR'] = self.fileServerDir
         privateKey = ed25519.SigningKey(PRIVATE_KEY.encode('utf-8'),
                                         encoding='base64')
-        signature = privateKey.sign(six.b(json.dumps(VERSIONS, sort_keys=True)),
-                                    encoding='base64').decode()
+        versionsJson = json.dumps(VERSIONS, sort_keys=True).encode('utf-8')
+        signature = privateKey.sign(versionsJson, encoding='base64').decode()
         VERSIONS['signature'] = signature
         keysFilePath = os.path.join(self.fileServerDir, 'keys.gz')
         with gzip.open(keysFilePath, 'wb') as keysFile: